@@ -1,79 +1,180 @@
 """An example flask application demonstrating server-sent events."""
 
+from collections import OrderedDict
 from hashlib import sha1
-from shutil import rmtree
-from stat import S_ISREG, ST_CTIME, ST_MODE
+from io import BytesIO
+import ipaddress
+from math import ceil
 import json
 import os
+import sqlite3
+import threading
 import time
 
 from PIL import Image, ImageFile
 from gevent.event import AsyncResult
+from gevent.monkey import get_original
 from gevent.queue import Empty, Queue
+from gevent.threadpool import ThreadPool
 from gevent.timeout import Timeout
+from markupsafe import escape
 import flask
 
 import cv2 # for image processing
 import numpy as np # to store image
-import sys
 
-# input a image path and it will output a cartoonified image
-def better_cartoonify(image_path, numDownSamples = 2, numBilateralFilters = 15, resize_shape=(1920,1080)):
-    ## Get image ##
-    orig = cv2.imread(image_path) 
-    orig = cv2.cvtColor(orig, cv2.COLOR_BGR2RGB)
-    images = {}
-    if orig is None:
-        print("Path incorrect, no image found")
-        sys.exit()
-
-    ## Original ##
-    ## Resize to resize_shape ##
-    images['orig1'] = cv2.resize(orig, resize_shape)
+## Pipeline stages ##
+# Each stage takes its params and the outputs of the stages it depends on.
 
-    ## Placeholder ##
-    images['placeholder'] = images['orig1'].copy()
+def load_stage(params, image_path):
+    orig = cv2.imread(image_path)
+    if orig is None:
+        raise IOError('no image found at {}'.format(image_path))
+    return cv2.cvtColor(orig, cv2.COLOR_BGR2RGB)
 
+def downsample_stage(params, orig):
     ## downsample image using Gaussian pyramid ##
-    for _ in range(numDownSamples): 
+    for _ in range(params['numDownSamples']):
       orig = cv2.pyrDown(orig)
-    images['downsample'] = cv2.resize(orig, resize_shape)
+    return orig
 
+def bilateral_stage(params, orig):
     ## repeatedly apply small bilateral filter instead of applying ##
     ## one large filter ##
-    for _ in range(numBilateralFilters): 
+    for _ in range(params['numBilateralFilters']):
       orig = cv2.bilateralFilter(orig, 2, 2, 2) # arguments of diameter of each pixel neighborhood, sigmaColor, sigmaColor (https://www.geeksforgeeks.org/python-bilateral-filtering/)
-    images['bilateral'] = cv2.resize(orig, resize_shape)
+    return orig
 
-    # upsample image to original size 
-    for _ in range(numDownSamples): 
+def upsample_stage(params, orig):
+    # upsample image to original size
+    for _ in range(params['numDownSamples']):
       orig = cv2.pyrUp(orig)
-    images['upsample'] = cv2.resize(orig, resize_shape)
 
     ## MedianBlur for even more blur ##
     # orig = cv2.medianBlur(orig, 3)
-    images['blur'] = cv2.resize(orig, resize_shape)
+    return orig
 
+def grayscale_stage(params, orig):
     ## Grayscale (to improve smoothing) ##
-    grayScaleImage = cv2.cvtColor(orig, cv2.COLOR_BGR2GRAY)
-    images['grayscale'] = cv2.resize(grayScaleImage, resize_shape)
+    return cv2.cvtColor(orig, cv2.COLOR_BGR2GRAY)
 
-    ## Adaptive Edge Threshold ## # TODO: thinner edges and greater threshold 
-    getEdge = cv2.adaptiveThreshold(grayScaleImage, 255, 
-                                    cv2.ADAPTIVE_THRESH_MEAN_C, 
-                                    cv2.THRESH_BINARY, 9, 2) # TODO: increase threshold
-    images['edge'] = cv2.resize(getEdge, resize_shape)
+def edge_stage(params, grayScaleImage):
+    ## Adaptive Edge Threshold ## # TODO: thinner edges and greater threshold
+    return cv2.adaptiveThreshold(grayScaleImage, 255,
+                                 cv2.ADAPTIVE_THRESH_MEAN_C,
+                                 cv2.THRESH_BINARY,
+                                 params['blockSize'], params['C'])
 
+def color_stage(params, orig):
     ## Color Filter ##
-    colorImage = cv2.bilateralFilter(orig, 9, 300, 300) # filter color
-    images['color filter'] = cv2.resize(colorImage, resize_shape)
+    return cv2.bilateralFilter(orig, 9, 300, 300) # filter color
 
+def combined_stage(params, colorImage, getEdge):
     ## Combined ##
-    cartoonImage = cv2.bitwise_and(colorImage, colorImage, mask=getEdge) # combind image and edges
-    images['combined'] = cv2.resize(cartoonImage, resize_shape)
+    return cv2.bitwise_and(colorImage, colorImage, mask=getEdge) # combind image and edges
+
+# stage name -> (function, stages it depends on, params it reads)
+STAGES = {
+    'orig': (load_stage, (), ()),
+    'downsample': (downsample_stage, ('orig',), ('numDownSamples',)),
+    'bilateral': (bilateral_stage, ('downsample',), ('numBilateralFilters',)),
+    'upsample': (upsample_stage, ('bilateral',), ('numDownSamples',)),
+    'grayscale': (grayscale_stage, ('upsample',), ()),
+    'edge': (edge_stage, ('grayscale',), ('blockSize', 'C')),
+    'color': (color_stage, ('upsample',), ()),
+    'combined': (combined_stage, ('color', 'edge'), ()),
+}
+# stage -> param that turns it into a no-op when 0
+PASSTHROUGH = {'downsample': 'numDownSamples',
+               'bilateral': 'numBilateralFilters',
+               'upsample': 'numDownSamples'}
+DEFAULT_PARAMS = {'numDownSamples': 2, 'numBilateralFilters': 15,
+                  'blockSize': 9, 'C': 2}
+
+
+def passthrough(stage, params):
+    """Return the dependency a stage would hand on unchanged, or None.
+
+    Such stages are neither run nor cached, so one array is never counted
+    against the cache budget under several keys.
+    """
+    name = PASSTHROUGH.get(stage)
+    if name is not None and params[name] == 0:
+        return STAGES[stage][1][0]
+    return None
+
+
+def stage_key(image_path, stage, params):
+    """Identify a stage output by its input image and every param upstream."""
+    dep = passthrough(stage, params)
+    if dep is not None:
+        return stage_key(image_path, dep, params)
+    _, deps, names = STAGES[stage]
+    return (stage, tuple(params[name] for name in names),
+            tuple(stage_key(image_path, dep, params) for dep in deps)
+            or image_path)
+
+
+def render_stage(image_path, stage, params):
+    """Return the output of stage, reusing cached upstream outputs."""
+    dep = passthrough(stage, params)
+    if dep is not None:
+        return render_stage(image_path, dep, params)
+    key = stage_key(image_path, stage, params)
+    with STAGE_CACHE_LOCK:  # stages run on PIPELINE_POOL threads
+        if key in STAGE_CACHE:
+            STAGE_CACHE.move_to_end(key)
+            STAGE_CACHE_METRICS['hits'] += 1
+            return STAGE_CACHE[key]
+        STAGE_CACHE_METRICS['misses'] += 1
+    function, deps, _ = STAGES[stage]
+    if deps:
+        inputs = [render_stage(image_path, dep, params) for dep in deps]
+    else:
+        inputs = [image_path]
+    output = function(params, *inputs)
+    with STAGE_CACHE_LOCK:
+        if key not in STAGE_CACHE:
+            STAGE_CACHE_METRICS['bytes'] += output.nbytes
+        STAGE_CACHE[key] = output
+        while STAGE_CACHE_METRICS['bytes'] > MAX_STAGE_CACHE_BYTES \
+                and len(STAGE_CACHE) > 1:
+            _, evicted = STAGE_CACHE.popitem(last=False)
+            STAGE_CACHE_METRICS['bytes'] -= evicted.nbytes
+            STAGE_CACHE_METRICS['evictions'] += 1
+    return output
+
+
+def missing_stages(image_path, stage, params):
+    """Return the stages `render_stage` would have to compute for stage."""
+    dep = passthrough(stage, params)
+    if dep is not None:
+        return missing_stages(image_path, dep, params)
+    if stage_key(image_path, stage, params) in STAGE_CACHE:
+        return set()
+    missing = {stage}
+    for dep in STAGES[stage][1]:
+        missing |= missing_stages(image_path, dep, params)
+    return missing
+
+
+def rendition_path(image_path, params):
+    """Name the cartoon output of image_path for the given params."""
+    if params == DEFAULT_PARAMS:
+        return image_path.replace('.jpg', '_cartoon.jpg')
+    return image_path.replace('.jpg', '_{numDownSamples}_{numBilateralFilters}'
+                              '_{blockSize}_{C}_cartoon.jpg'.format(**params))
+
+
+# input a image path and it will output a cartoonified image
+def better_cartoonify(image_path, numDownSamples = 2, numBilateralFilters = 15, blockSize = 9, C = 2):
+    params = {'numDownSamples': numDownSamples,
+              'numBilateralFilters': numBilateralFilters,
+              'blockSize': blockSize, 'C': C}
+    cartoonImage = render_stage(image_path, 'combined', params)
 
     im = Image.fromarray(cartoonImage)
-    new_path = image_path.replace('.jpg', '_cartoon.jpg')
+    new_path = rendition_path(image_path, params)
     im.save(new_path)
     return new_path
 
@@ -83,20 +184,108 @@ def better_cartoonify(image_path, numDownSamples = 2, numBilateralFilters = 15,
 DATA_DIR = 'tmp'
 KEEP_ALIVE_DELAY = 25
 MAX_IMAGE_SIZE = 1200, 800
-MAX_IMAGES = 10
+MAX_IMAGES = 10  # images per gallery page
+MAX_PAGE_SIZE = 100
 MAX_DURATION = 300
 
+## Admission control ##
+# Cost is measured in megapixel-passes of the cartoonify pipeline, see
+# `estimate_cost`. All limits apply per gunicorn worker: with N workers the
+# server admits up to N * MAX_INFLIGHT_COST and each client gets N buckets.
+# Passes each stage makes over the image; bilateral depends on its params
+STAGE_PASSES = {'orig': 1, 'downsample': 0.25, 'bilateral': None,
+                'upsample': 0.25, 'grayscale': 0.1, 'edge': 0.25,
+                'color': 8,  # 9px bilateral filter vs. the 2px ones
+                'combined': 0.5}
+CLIENT_BUCKET_CAPACITY = 60  # burst allowance per client
+CLIENT_REFILL_RATE = 2.0  # cost units restored per second
+MAX_CLIENT_BUCKETS = 10000
+MAX_INFLIGHT_COST = 80  # total cost allowed to run concurrently
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # larger bodies are refused unread
+COST_THROUGHPUT = 20.0  # cost units the server completes per second
+# cv2 releases the GIL, so running the pipeline on threads keeps the gevent
+# loop free to accept (and shed) requests while images are processed
+PIPELINE_THREADS = os.cpu_count() or 1
+
+## Stage cache ##
+MAX_STAGE_CACHE_BYTES = 256 * 1024 * 1024
+# Bounds accepted by /rerender
+MAX_DOWN_SAMPLES = 4
+MAX_BILATERAL_FILTERS = 30
+MAX_BLOCK_SIZE = 51
+MAX_C = 64  # C may also be negative down to -MAX_C
+
+## Image history ##
+INDEX_PATH = 'images.sqlite3'  # kept outside DATA_DIR so it isn't served
+MAX_HISTORY_AGE = 7 * 24 * 3600
+MAX_HISTORY_BYTES = 1024 * 1024 * 1024
+INDEX_VERSION = 1  # PRAGMA user_version of the index schema
+RETENTION_INTERVAL = 60  # seconds between retention sweeps
+RETENTION_BATCH = 100  # entries expired per transaction
+# Files in DATA_DIR without an index entry are removed once this old, which
+# leaves time for in-flight requests to record the files they are writing
+ORPHAN_GRACE = 600
+ORPHAN_INTERVAL = 3600  # minimum seconds between sweeps for such files
+
 app = flask.Flask(__name__, static_folder=DATA_DIR)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 BROADCAST_QUEUE = Queue()
-
-
-try:  # Reset saved files on each start
-    rmtree(DATA_DIR, True)
+PIPELINE_POOL = ThreadPool(PIPELINE_THREADS)
+# client address -> (tokens, last refill time), least recently seen first
+CLIENT_BUCKETS = OrderedDict()
+INFLIGHT = {'cost': 0.0, 'requests': 0}
+ADMISSION_METRICS = {'admitted': 0, 'rejected_client': 0,
+                     'rejected_saturated': 0, 'rejected_invalid': 0,
+                     'admitted_cost': 0.0, 'rejected_cost': 0.0}
+STAGE_CACHE = OrderedDict()  # stage_key -> output, least recently used first
+STAGE_CACHE_METRICS = {'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+STAGE_CACHE_LOCK = threading.Lock()
+RETENTION = {'started': False, 'expired': 0, 'orphans': 0}
+RETENTION_LOCK = threading.Lock()
+
+
+try:  # Saved files persist across restarts along with their index
     os.mkdir(DATA_DIR)
 except OSError:
     pass
 
 
+
+def open_index(path):
+    """Connect to the history index at path, creating it if needed.
+
+    Raises RuntimeError if the index was written with a different schema.
+    """
+    db = sqlite3.connect(path, check_same_thread=False)
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version == INDEX_VERSION:
+        return db
+    if version != 0 or db.execute('SELECT 1 FROM sqlite_master '
+                                  "WHERE type = 'table'").fetchone():
+        raise RuntimeError('{} has index version {}, expected {}; move it '
+                           'aside to start a new history'
+                           .format(path, version, INDEX_VERSION))
+    with db:
+        db.execute('CREATE TABLE images ('
+                   'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                   'sha1 TEXT NOT NULL, created REAL NOT NULL, '
+                   'ip_addr TEXT NOT NULL, original TEXT NOT NULL, '
+                   'src TEXT NOT NULL)')
+        # Several entries can share a file, so sizes are tracked per file
+        db.execute('CREATE TABLE files (path TEXT PRIMARY KEY, '
+                   'bytes INTEGER NOT NULL, refs INTEGER NOT NULL)')
+        # Running total of files.bytes, so sweeps don't have to sum the table
+        db.execute('CREATE TABLE disk_usage (bytes INTEGER NOT NULL)')
+        db.execute('INSERT INTO disk_usage VALUES (0)')
+        db.execute('PRAGMA user_version = {}'.format(INDEX_VERSION))
+    return db
+
+
+# Used by request handlers; the dev server runs those on real threads
+DB = open_index(INDEX_PATH)
+DB_LOCK = threading.Lock()
+
+
 def broadcast(message):
     """Notify all waiting waiting gthreads of message."""
     waiting = []
@@ -132,8 +321,262 @@ def receive():
 
 
 def safe_addr(ip_addr):
-    """Strip off the trailing two octets of the IP address."""
-    return '.'.join(ip_addr.split('.')[:2] + ['xxx', 'xxx'])
+    """Strip off the trailing two octets of an IPv4 address, or everything
+    past the /48 prefix of an IPv6 one."""
+    try:
+        address = ipaddress.ip_address(ip_addr)
+    except ValueError:
+        return 'unknown'  # access_route can hold any X-Forwarded-For value
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    if address.version == 4:
+        return '.'.join(str(address).split('.')[:2] + ['xxx', 'xxx'])
+    return str(ipaddress.ip_network('{}/48'.format(address), strict=False))
+
+
+def estimate_cost(data, params=DEFAULT_PARAMS, stages=STAGES):
+    """Estimate the cost of running stages on an image from its header alone.
+
+    Returns None if the data is not a readable image.
+    """
+    try:
+        width, height = Image.open(BytesIO(data)).size
+    except (IOError, Image.DecompressionBombError):
+        return None
+    # `save_normalized_image` thumbnails before cartoonifying
+    scale = min(1.0, float(MAX_IMAGE_SIZE[0]) / width,
+                float(MAX_IMAGE_SIZE[1]) / height)
+    megapixels = width * height * scale * scale / 1e6
+    passes = 0
+    for stage in stages:
+        if stage == 'bilateral':
+            # bilateral passes run on the downsampled image
+            passes += params['numBilateralFilters'] \
+                / 4.0 ** params['numDownSamples']
+        else:
+            passes += STAGE_PASSES[stage]
+    return min(megapixels * passes, CLIENT_BUCKET_CAPACITY)
+
+
+def take_tokens(client, cost):
+    """Charge cost to the client's token bucket.
+
+    Returns the number of seconds to wait, 0 if the tokens were taken.
+    """
+    now = time.time()
+    tokens, last = CLIENT_BUCKETS.pop(client, (CLIENT_BUCKET_CAPACITY, now))
+    tokens = min(CLIENT_BUCKET_CAPACITY,
+                 tokens + (now - last) * CLIENT_REFILL_RATE)
+    wait = 0
+    if tokens < cost:
+        wait = (cost - tokens) / CLIENT_REFILL_RATE
+    else:
+        tokens -= cost
+    CLIENT_BUCKETS[client] = tokens, now
+    while len(CLIENT_BUCKETS) > MAX_CLIENT_BUCKETS:
+        CLIENT_BUCKETS.popitem(last=False)
+    return wait
+
+
+def admit(client, cost):
+    """Decide whether a request of the given cost may run now.
+
+    Returns (reason, retry_after); reason is None when admitted, in which
+    case the caller must `release` the cost when done.
+    """
+    if cost is None:
+        reason, retry_after = 'rejected_invalid', 0
+    elif INFLIGHT['requests'] and \
+            INFLIGHT['cost'] + cost > MAX_INFLIGHT_COST:
+        # Shed load rather than queueing behind work we can't finish soon
+        reason = 'rejected_saturated'
+        retry_after = (INFLIGHT['cost'] + cost - MAX_INFLIGHT_COST) \
+            / COST_THROUGHPUT
+    else:
+        retry_after = take_tokens(client, cost)
+        reason = 'rejected_client' if retry_after else None
+    ADMISSION_METRICS[reason or 'admitted'] += 1
+    if reason is None:
+        ADMISSION_METRICS['admitted_cost'] += cost
+        INFLIGHT['cost'] += cost
+        INFLIGHT['requests'] += 1
+    elif cost is not None:
+        ADMISSION_METRICS['rejected_cost'] += cost
+    return reason, int(ceil(retry_after))
+
+
+def read_upload():
+    """Return the request body, aborting with 413 if it is too large.
+
+    The raw body isn't covered by MAX_CONTENT_LENGTH, so check the declared
+    length up front and never read more than the limit.
+    """
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if (flask.request.content_length or 0) > limit:
+        flask.abort(413)
+    data = flask.request.stream.read(limit + 1)
+    if len(data) > limit:
+        flask.abort(413)
+    return data
+
+
+def admission_response(reason, retry_after):
+    """Build the error response for a request `admit` turned away."""
+    if reason == 'rejected_invalid':
+        return 'invalid image', 400
+    return flask.Response('too many requests, retry in {}s'
+                          .format(retry_after), status=429,
+                          headers={'Retry-After': str(retry_after)})
+
+
+def release(cost):
+    """Return admitted cost once its request has finished."""
+    INFLIGHT['cost'] = max(0.0, INFLIGHT['cost'] - cost)
+    INFLIGHT['requests'] -= 1
+
+
+def add_file_ref(db, path):
+    """Count one more index entry referring to path.
+
+    Must be called inside a transaction.
+    """
+    size = os.path.getsize(path)
+    row = db.execute('SELECT bytes FROM files WHERE path = ?',
+                     (path,)).fetchone()
+    if row:
+        # The file may have been rewritten, e.g. by a repeated re-render
+        db.execute('UPDATE files SET bytes = ?, refs = refs + 1 '
+                   'WHERE path = ?', (size, path))
+        size -= row[0]
+    else:
+        db.execute('INSERT INTO files (path, bytes, refs) VALUES (?, ?, 1)',
+                   (path, size))
+    db.execute('UPDATE disk_usage SET bytes = bytes + ?', (size,))
+
+
+def drop_file_ref(db, path):
+    """Count one less index entry referring to path.
+
+    Must be called inside a transaction. Returns True when nothing refers
+    to path any more and it should be unlinked.
+    """
+    db.execute('UPDATE files SET refs = refs - 1 WHERE path = ?', (path,))
+    row = db.execute('SELECT bytes, refs FROM files WHERE path = ?',
+                     (path,)).fetchone()
+    if row is None or row[1] > 0:
+        return False
+    db.execute('DELETE FROM files WHERE path = ?', (path,))
+    db.execute('UPDATE disk_usage SET bytes = bytes - ?', (row[0],))
+    return True
+
+
+def record_image(sha1sum, ip_addr, original, src):
+    """Add a rendition to the history index."""
+    with DB_LOCK, DB:
+        add_file_ref(DB, original)
+        add_file_ref(DB, src)
+        DB.execute('INSERT INTO images (sha1, created, ip_addr, original, '
+                   'src) VALUES (?, ?, ?, ?, ?)',
+                   (sha1sum, time.time(), ip_addr, original, src))
+
+
+def expire_images(db):
+    """Drop history older than MAX_HISTORY_AGE, then oldest first until the
+    files left fit in MAX_HISTORY_BYTES.
+
+    Files are unlinked once no remaining entry refers to them. Returns the
+    number of entries removed.
+    """
+    cutoff = time.time() - MAX_HISTORY_AGE
+    expired = 0
+    done = False
+    while not done:
+        rows = db.execute('SELECT id, created, original, src FROM images '
+                          'ORDER BY id LIMIT ?', (RETENTION_BATCH,)).fetchall()
+        done = len(rows) < RETENTION_BATCH
+        unused = []
+        with db:
+            for image_id, created, original, src in rows:
+                if created >= cutoff and db.execute(
+                        'SELECT bytes FROM disk_usage').fetchone()[0] \
+                        <= MAX_HISTORY_BYTES:
+                    done = True
+                    break
+                # Another worker's sweep may have got here first
+                if not db.execute('DELETE FROM images WHERE id = ?',
+                                  (image_id,)).rowcount:
+                    continue
+                unused += [path for path in (src, original)
+                           if drop_file_ref(db, path)]
+                expired += 1
+        for path in unused:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return expired
+
+
+def remove_orphans(db):
+    """Unlink files in DATA_DIR that no index entry refers to, such as
+    leftovers from failed renders or earlier deploys.
+
+    Returns the number of files removed.
+    """
+    cutoff = time.time() - ORPHAN_GRACE
+    removed = 0
+    for filename in os.listdir(DATA_DIR):
+        path = os.path.join(DATA_DIR, filename)
+        try:
+            if os.path.getmtime(path) >= cutoff or db.execute(
+                    'SELECT 1 FROM files WHERE path = ?', (path,)).fetchone():
+                continue
+            os.unlink(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def retention_loop():
+    """Expire history every RETENTION_INTERVAL seconds and remove orphaned
+    files every ORPHAN_INTERVAL, starting with both.
+
+    Runs on its own native thread and connection, so sweeps never stall
+    the event loop serving requests.
+    """
+    db = open_index(INDEX_PATH)
+    last_orphan_sweep = 0.0
+    while True:
+        try:
+            RETENTION['expired'] += expire_images(db)
+            if time.time() - last_orphan_sweep >= ORPHAN_INTERVAL:
+                last_orphan_sweep = time.time()
+                RETENTION['orphans'] += remove_orphans(db)
+        except (OSError, sqlite3.Error) as exception:
+            print('Retention sweep failed: {!r}'.format(exception))
+        time.sleep(RETENTION_INTERVAL)
+
+
+def list_images(cursor=None, limit=MAX_IMAGES):
+    """Return a page of history newest first, and the cursor for the next.
+
+    The cursor is the id of the last entry returned, so every page is a
+    primary key range scan regardless of how much history there is.
+    """
+    query = 'SELECT id, sha1, created, ip_addr, original, src FROM images'
+    with DB_LOCK:
+        if cursor is None:
+            rows = DB.execute(query + ' ORDER BY id DESC LIMIT ?',
+                              (limit + 1,)).fetchall()
+        else:
+            rows = DB.execute(query + ' WHERE id < ? ORDER BY id DESC LIMIT ?',
+                              (cursor, limit + 1)).fetchall()
+    images = [{'id': row[0], 'sha1': row[1], 'created': row[2],
+               'ip_addr': row[3], 'original': row[4], 'src': row[5]}
+              for row in rows[:limit]]
+    next_cursor = images[-1]['id'] if len(rows) > limit else None
+    return images, next_cursor
 
 
 def save_normalized_image(path, data):
@@ -154,6 +597,32 @@ def save_normalized_image(path, data):
     return True, cartoonified_image_path
 
 
+def parse_params(args):
+    """Read pipeline params from request args, falling back to defaults.
+
+    Returns (params, error); error is None when params are usable.
+    """
+    params = dict(DEFAULT_PARAMS)
+    for name in params:
+        try:
+            params[name] = int(args.get(name, params[name]))
+        except ValueError:
+            return None, '{} must be an integer'.format(name)
+    if not 0 <= params['numDownSamples'] <= MAX_DOWN_SAMPLES:
+        return None, 'numDownSamples must be between 0 and {}'.format(
+            MAX_DOWN_SAMPLES)
+    if not 0 <= params['numBilateralFilters'] <= MAX_BILATERAL_FILTERS:
+        return None, 'numBilateralFilters must be between 0 and {}'.format(
+            MAX_BILATERAL_FILTERS)
+    if not 3 <= params['blockSize'] <= MAX_BLOCK_SIZE \
+            or params['blockSize'] % 2 == 0:
+        return None, 'blockSize must be odd and between 3 and {}'.format(
+            MAX_BLOCK_SIZE)
+    if not -MAX_C <= params['C'] <= MAX_C:
+        return None, 'C must be between {} and {}'.format(-MAX_C, MAX_C)
+    return params, None
+
+
 def event_stream(client):
     """Yield messages as they come in."""
     force_disconnect = False
@@ -167,25 +636,110 @@ def event_stream(client):
             print('{} disconnected from stream'.format(client))
 
 
+@app.before_request
+def start_retention():
+    """Start sweeping history on a native thread, even under monkey
+    patching, once the app is actually serving."""
+    with RETENTION_LOCK:
+        if RETENTION['started']:
+            return
+        RETENTION['started'] = True
+    get_original('_thread', 'start_new_thread')(retention_loop, ())
+
+
 @app.route('/post', methods=['POST'])
 def post():
     """Handle image uploads."""
-    sha1sum = sha1(flask.request.data).hexdigest()
+    data = read_upload()
+    cost = estimate_cost(data)
+    reason, retry_after = admit(flask.request.access_route[0], cost)
+    if reason is not None:
+        return admission_response(reason, retry_after)
+    sha1sum = sha1(data).hexdigest()
     target = os.path.join(DATA_DIR, '{}.jpg'.format(sha1sum))
     message = json.dumps({'src': target,
                           'ip_addr': safe_addr(flask.request.access_route[0])})
     try:
         ## making program more robust by not hard coding anything ##
-        saving_success, cartoonified_image_path = save_normalized_image(target, flask.request.data)
-        cartoonified_image_path = '.\\{}'.format(cartoonified_image_path)
+        saving_success, cartoonified_image_path = PIPELINE_POOL.apply(
+            save_normalized_image, (target, data))
         if saving_success:
+            record_image(sha1sum,
+                         safe_addr(flask.request.access_route[0]),
+                         target, cartoonified_image_path)
             message = json.dumps({'src': cartoonified_image_path, 'ip_addr': safe_addr(flask.request.access_route[0])})
             broadcast(message)  # Notify subscribers of completion
     except Exception as exception:  # Output errors
         return '{}'.format(exception)
+    finally:
+        release(cost)
     return 'saved to {}'.format(cartoonified_image_path)
 
 
+@app.route('/rerender/<sha1sum>', methods=['POST'])
+def rerender(sha1sum):
+    """Re-run the pipeline on an earlier upload with different params.
+
+    Only stages downstream of a changed param are recomputed.
+    """
+    if len(sha1sum) != 40 or not all(c in '0123456789abcdef' for c in sha1sum):
+        return 'invalid image id', 400
+    target = os.path.join(DATA_DIR, '{}.jpg'.format(sha1sum))
+    if not os.path.isfile(target):
+        return 'image not found', 404
+    params, error = parse_params(flask.request.args)
+    if error:
+        return error, 400
+    # Only charge for the stages a re-render can't take from the cache
+    with open(target, 'rb') as fp:
+        cost = estimate_cost(fp.read(), params,
+                             missing_stages(target, 'combined', params))
+    reason, retry_after = admit(flask.request.access_route[0], cost)
+    if reason is not None:
+        return admission_response(reason, retry_after)
+    try:
+        cartoonified_image_path = PIPELINE_POOL.apply(
+            better_cartoonify, (target,), params)
+        record_image(sha1sum, safe_addr(flask.request.access_route[0]),
+                     target, cartoonified_image_path)
+        broadcast(json.dumps({'src': cartoonified_image_path,
+                              'ip_addr': safe_addr(flask.request.access_route[0])}))
+    except Exception as exception:  # Log errors, don't leak paths to clients
+        print('Re-render of {} failed: {!r}'.format(sha1sum, exception))
+        return 'render failed', 500
+    finally:
+        release(cost)
+    return 'saved to {}'.format(cartoonified_image_path)
+
+
+@app.route('/api/images')
+def api_images():
+    """Page through image history, newest first."""
+    # An empty cursor, as in `?cursor=`, asks for the first page
+    cursor = flask.request.args.get('cursor') or None
+    limit = flask.request.args.get('limit') or MAX_IMAGES
+    try:
+        cursor = cursor and int(cursor)
+        limit = int(limit)
+    except ValueError:
+        return 'cursor and limit must be integers', 400
+    images, next_cursor = list_images(cursor, max(1, min(limit, MAX_PAGE_SIZE)))
+    return flask.jsonify({'images': images, 'next_cursor': next_cursor})
+
+
+@app.route('/metrics')
+def metrics():
+    """Report admission control decisions and current load."""
+    return flask.jsonify(dict(ADMISSION_METRICS,
+                              inflight_cost=INFLIGHT['cost'],
+                              inflight_requests=INFLIGHT['requests'],
+                              tracked_clients=len(CLIENT_BUCKETS),
+                              expired_images=RETENTION['expired'],
+                              orphaned_files=RETENTION['orphans'],
+                              stage_cache=dict(STAGE_CACHE_METRICS,
+                                               entries=len(STAGE_CACHE))))
+
+
 @app.route('/stream')
 def stream():
     """Handle long-lived SSE streams."""
@@ -195,21 +749,12 @@ def stream():
 @app.route('/')
 def home():
     """Provide the primary view along with its javascript."""
-    # Code adapted from: http://stackoverflow.com/questions/168409/
-    image_infos = []
-    for filename in os.listdir(DATA_DIR):
-        filepath = os.path.join(DATA_DIR, filename)
-        file_stat = os.stat(filepath)
-        if S_ISREG(file_stat[ST_MODE]):
-            image_infos.append((file_stat[ST_CTIME], filepath))
-
-    images = []
-    for i, (_, path) in enumerate(sorted(image_infos, reverse=True)):
-        if i >= MAX_IMAGES:
-            os.unlink(path)
-            continue
-        images.append('<div><img alt="User uploaded image" src="{}" /></div>'
-                      .format(path))
+    images, next_cursor = list_images()
+    images = ['<div><div>Image uploaded by {}</div>'
+              '<img alt="Image uploaded by {}" src="{}" /></div>'
+              .format(escape(image['ip_addr']), escape(image['ip_addr']),
+                      escape(image['src']))
+              for image in images]
     return """
 
 <!doctype html>
@@ -253,7 +798,7 @@ def home():
 </style>
 <h3>Image Uploader</h3>
 <p>Upload an image for everyone to see. Valid images are pushed to everyone
-currently connected, and only the most recent %s images are saved.</p>
+currently connected, and older images can be browsed %s at a time.</p>
 <p>The complete source for this Flask web service can be found at:
 <a href="https://github.com/bboe/flask-image-uploader">https://github.com/bboe/flask-image-uploader</a></p>
 <p class="notice">Disclaimer: The author of this application accepts no responsibility for the
@@ -269,7 +814,26 @@ dynamically view new images.</noscript>
 </fieldset>
 <h3>Uploaded Images (updated in real-time)</h3>
 <div id="images">%s</div>
+<button id="more">Load older images</button>
 <script>
+  var cursor = %s;
+  function load_older() {
+      $.getJSON('/api/images', {cursor: cursor}, function(data) {
+          $.each(data['images'], function(i, item) {
+              var upload_message = 'Image uploaded by ' + item['ip_addr'];
+              var container = $('<div>');
+              container.append($('<div>', {text: upload_message}));
+              container.append($('<img>', {alt: upload_message, src: item['src']}));
+              $('#images').append(container);
+          });
+          cursor = data['next_cursor'];
+          if (cursor === null)
+              $('#more').hide();
+      });
+  }
+  $('#more').click(load_older);
+  if (cursor === null)
+      $('#more').hide();
   function sse() {
       var source = new EventSource('/stream');
       source.onmessage = function(e) {
@@ -339,7 +903,7 @@ dynamically view new images.</noscript>
     var s = document.getElementsByTagName('script')[0]; s.parentNode.insertBefore(ga, s);
   })();
 </script>
-""" % (MAX_IMAGES, '\n'.join(images))  # noqa
+""" % (MAX_IMAGES, '\n'.join(images), json.dumps(next_cursor))  # noqa
 
 
 if __name__ == '__main__':
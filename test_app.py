@@ -0,0 +1,164 @@
+"""Tests for admission control and the image history index."""
+
+from collections import OrderedDict
+import math
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def index(monkeypatch, tmp_path):
+    """Give each test an empty history index and data directory."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(app.DATA_DIR)
+    db = app.open_index(':memory:')
+    monkeypatch.setattr(app, 'DB', db)
+    return db
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    """Give each test fresh buckets, load and metrics."""
+    monkeypatch.setattr(app, 'CLIENT_BUCKETS', OrderedDict())
+    monkeypatch.setattr(app, 'INFLIGHT', {'cost': 0.0, 'requests': 0})
+    monkeypatch.setattr(app, 'ADMISSION_METRICS',
+                        dict.fromkeys(app.ADMISSION_METRICS, 0))
+
+
+def record(sha1sum, suffix='_cartoon', size=5):
+    """Write an original and a rendition of size bytes each and index them."""
+    paths = []
+    for name in (sha1sum, sha1sum + suffix):
+        path = os.path.join(app.DATA_DIR, '{}.jpg'.format(name))
+        with open(path, 'wb') as fp:
+            fp.write(b'x' * size)
+        paths.append(path)
+    app.record_image(sha1sum, '1.2.xxx.xxx', *paths)
+    return paths
+
+
+def disk_usage(db):
+    return db.execute('SELECT bytes FROM disk_usage').fetchone()[0]
+
+
+def file_refs(db):
+    return dict(db.execute('SELECT path, refs FROM files'))
+
+
+def image_ids(db):
+    return [row[0] for row in db.execute('SELECT id FROM images ORDER BY id')]
+
+
+def get_page(query):
+    with app.app.test_request_context('/api/images' + query):
+        return app.api_images().get_json()
+
+
+def test_refs_shared_across_duplicate_uploads_and_rerenders(index,
+                                                             monkeypatch):
+    original, src = record('a' * 40)
+    record('a' * 40)  # the same upload again
+    # A re-render that also rewrites the original at a new size
+    _, rerendered = record('a' * 40, '_2_15_11_2_cartoon', size=7)
+    assert file_refs(index) == {original: 3, src: 2, rerendered: 1}
+    assert disk_usage(index) == 7 + 5 + 7
+
+    # Expiring the first upload leaves files the others still refer to
+    index.execute('UPDATE images SET created = 0 WHERE id = 1')
+    assert app.expire_images(index) == 1
+    assert file_refs(index) == {original: 2, src: 1, rerendered: 1}
+    assert disk_usage(index) == 7 + 5 + 7
+    assert all(os.path.exists(path) for path in (original, src, rerendered))
+
+    monkeypatch.setattr(app, 'MAX_HISTORY_AGE', -1)
+    assert app.expire_images(index) == 2
+    assert file_refs(index) == {}
+    assert disk_usage(index) == 0
+    assert os.listdir(app.DATA_DIR) == []
+
+
+def test_expire_images_keeps_to_size_budget(index, monkeypatch):
+    monkeypatch.setattr(app, 'RETENTION_BATCH', 3)
+    monkeypatch.setattr(app, 'MAX_HISTORY_BYTES', 45)
+    paths = [record('{:040x}'.format(i)) for i in range(7)]
+    assert app.expire_images(index) == 3
+    assert image_ids(index) == [4, 5, 6, 7]
+    assert disk_usage(index) == 40
+    assert not any(os.path.exists(path) for pair in paths[:3] for path in pair)
+    assert all(os.path.exists(path) for pair in paths[3:] for path in pair)
+
+
+def test_expire_images_keeps_to_age_budget(index):
+    for i in range(3):
+        record('{:040x}'.format(i))
+    index.execute('UPDATE images SET created = created - ? WHERE id < 3',
+                  (2 * app.MAX_HISTORY_AGE,))
+    assert app.expire_images(index) == 2
+    assert image_ids(index) == [3]
+    assert disk_usage(index) == 10
+
+
+def test_remove_orphans_spares_indexed_and_recent_files(index, monkeypatch):
+    indexed = record('a' * 40)
+    orphan = os.path.join(app.DATA_DIR, 'orphan.jpg')
+    with open(orphan, 'wb') as fp:
+        fp.write(b'x')
+    assert app.remove_orphans(index) == 0  # still within ORPHAN_GRACE
+    monkeypatch.setattr(app, 'ORPHAN_GRACE', -1)
+    assert app.remove_orphans(index) == 1
+    assert sorted(os.listdir(app.DATA_DIR)) == sorted(
+        os.path.basename(path) for path in indexed)
+
+
+def test_api_images_pages_with_cursor(index):
+    for i in range(5):
+        record('{:040x}'.format(i))
+    page = get_page('?cursor=&limit=2')
+    assert [image['id'] for image in page['images']] == [5, 4]
+    assert page['next_cursor'] == 4
+    page = get_page('?cursor=4&limit=2')
+    assert [image['id'] for image in page['images']] == [3, 2]
+    page = get_page('?cursor={}&limit=2'.format(page['next_cursor']))
+    assert [image['id'] for image in page['images']] == [1]
+    assert page['next_cursor'] is None
+    assert get_page('')['images'][0]['id'] == 5
+
+
+def test_api_images_rejects_bad_cursor(index):
+    with app.app.test_request_context('/api/images?cursor=abc'):
+        assert app.api_images()[1] == 400
+
+
+def test_bucket_rejects_with_retry_after(admission):
+    assert app.admit('client', app.CLIENT_BUCKET_CAPACITY) == (None, 0)
+    app.release(app.CLIENT_BUCKET_CAPACITY)
+    reason, retry_after = app.admit('client', 9)
+    assert reason == 'rejected_client'
+    assert retry_after == math.ceil(9 / app.CLIENT_REFILL_RATE)
+    with app.app.test_request_context():
+        response = app.admission_response(reason, retry_after)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == str(retry_after)
+    # Other clients have buckets of their own
+    assert app.admit('other', 9) == (None, 0)
+
+
+def test_client_buckets_are_bounded(admission, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_CLIENT_BUCKETS', 2)
+    for client in ('a', 'b', 'c'):
+        app.take_tokens(client, 1)
+    app.take_tokens('b', 1)
+    assert list(app.CLIENT_BUCKETS) == ['c', 'b']
+
+
+@pytest.mark.parametrize('ip_addr, masked', [
+    ('128.111.4.7', '128.111.xxx.xxx'),
+    ('2001:db8:1:2::1', '2001:db8:1::/48'),
+    ('::ffff:10.1.2.3', '10.1.xxx.xxx'),
+    ('<script>alert(1)</script>', 'unknown'),
+])
+def test_safe_addr(ip_addr, masked):
+    assert app.safe_addr(ip_addr) == masked